@@ -1,18 +1,27 @@
 import os
+import logging
 from dotenv import load_dotenv
 from flask import Flask, render_template, request, redirect, url_for, session, flash
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+import pandas as pd
 from extensions import db
 from news_api_utils import get_stock_news
-from risk_calculator import analyze_portfolio, get_price_data
+from risk_calculator import get_price_data
+from tasks import get_portfolio_analysis, invalidate_portfolio_analysis
+
+logger = logging.getLogger(__name__)
 
 # Load variables from .env into os.environ
 load_dotenv()
 
 # Create the Flask app
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
+# Pin the session key so sessions survive restarts and deploys
+SECRET_KEY = os.environ.get("SECRET_KEY")
+if not SECRET_KEY:
+    raise RuntimeError("SECRET_KEY is not set. Please add it to your .env file.")
+app.config['SECRET_KEY'] = SECRET_KEY
 
 # Get database credentials from environment variables
 DB_USER = os.environ.get("DB_USER", "postgres")
@@ -26,11 +35,26 @@ app.config['SQLALCHEMY_BINDS'] = {
     'profile': f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_ENDPOINT}:{DB_PORT}/profile_db'
 }
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Connection pool settings (applied to both the default and profile binds)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_size": 20,
+    "max_overflow": 20,
+    "pool_pre_ping": True,   # Detect stale RDS connections before use
+    "pool_recycle": 1800,    # Recycle connections every 30 minutes
+    "pool_timeout": 30
+}
 
 # API configuration
 app.config['FINLIGHT_API_KEY'] = os.environ.get("FINLIGHT_API_KEY")
 app.config['NEWS_CACHE_TIMEOUT'] = 3600  # Cache news for 1 hour (in seconds)
 
+# Password hashing: scrypt is memory-hard and cheaper per login than pbkdf2 at 600k iterations
+PASSWORD_HASH_METHOD = "scrypt"
+# Checked against when the email is unknown so failed logins cost one scrypt check.
+# Accounts still on a legacy pbkdf2 hash are slower to verify (and so distinguishable
+# by timing) until their next successful login upgrades the hash.
+_DUMMY_HASH = generate_password_hash("dummy-password", method=PASSWORD_HASH_METHOD)
+
 # Initialize the database
 db.init_app(app)
 
@@ -53,7 +77,13 @@ def login():
         
         user = User.query.filter_by(email=email).first()
         
-        if user and check_password_hash(user.password, password):
+        # Always run one hash check so unknown emails can't be detected by timing
+        password_hash = user.password if user else _DUMMY_HASH
+        if check_password_hash(password_hash, password) and user:
+            # Upgrade legacy hashes to the current method while the plaintext is at hand
+            if not user.password.startswith(f"{PASSWORD_HASH_METHOD}:"):
+                user.password = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+                db.session.commit()
             session['user_id'] = user.id
             return redirect(url_for('dashboard'))
         else:
@@ -72,7 +102,7 @@ def signup():
             flash('Email already registered')
             return redirect(url_for('signup'))
         
-        hashed_password = generate_password_hash(password)
+        hashed_password = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
         new_user = User(email=email, password=hashed_password)
         
         db.session.add(new_user)
@@ -161,17 +191,31 @@ def user_info():
                 else:
                     stock_dict[stock_name] = share_count # if not existing, initialize share count
 
+        # Fetch all of the user's matching stocks in a single query
+        existing_stocks = {
+            stock.name: stock
+            for stock in Stock.query.filter(
+                Stock.user_id == user_id,
+                Stock.name.in_(stock_dict.keys())
+            ).all()
+        } if stock_dict else {}
+
         # updating to db
+        new_rows = []
         for stock_name, total_shares in stock_dict.items():
-            existing_stock = Stock.query.filter_by(user_id=user_id, name=stock_name).first()
+            existing_stock = existing_stocks.get(stock_name)
             
             if existing_stock:
                 existing_stock.shares += total_shares  
             else:
-                new_stock = Stock(user_id=user_id, name=stock_name, shares=total_shares)
-                db.session.add(new_stock)
+                new_rows.append({'user_id': user_id, 'name': stock_name, 'shares': total_shares})
+
+        # Insert new stocks in one batch, skipping per-object unit-of-work overhead
+        if new_rows:
+            db.session.bulk_insert_mappings(Stock, new_rows)
         
         db.session.commit()
+        invalidate_portfolio_analysis(user_id)
         return redirect(url_for('dashboard'))
     
     return render_template('user_info.html', user=user)
@@ -183,21 +227,29 @@ def dashboard():
     
     user_id = session['user_id']
     user = User.query.get(user_id)
-    profile = UserProfile.query.filter_by(user_id=user_id).first()
+
+    # Load the profile and its stocks together in one round-trip to the profile bind
+    rows = db.session.execute(
+        db.select(UserProfile, Stock)
+        .outerjoin(Stock, Stock.user_id == UserProfile.user_id)
+        .where(UserProfile.user_id == user_id)
+        .order_by(UserProfile.id, Stock.id)
+    ).all()
+    profile = rows[0][0] if rows else None
     
     # If the profile is not set up yet, redirect to complete user info.
     if not profile:
         flash("Please complete your profile information first.")
         return redirect(url_for('user_info'))
     
-    stocks = Stock.query.filter_by(user_id=user_id).all()
+    stocks = [stock for row_profile, stock in rows if row_profile is profile and stock is not None]
     stock_codes = [stock.name for stock in stocks if stock.name]
     
     # Call risk calculator and ensure the result has the expected keys.
     try:
-        risk_analysis = analyze_portfolio(user_id)
-    except Exception as e:
-        print("Error analyzing portfolio:", e)
+        risk_analysis = get_portfolio_analysis(user_id)
+    except Exception:
+        logger.exception("Error analyzing portfolio")
         risk_analysis = {}
     
     # Ensure that the risk_metrics key exists; set defaults if not.
@@ -226,47 +278,47 @@ def dashboard():
     if not risk_analysis.get("recommendations"):
         risk_analysis["recommendations"] = {"risk_gap": {"gap_amount": 0, "risk_allowed": 0}}
     
-    # Prepare historical chart data: last 15 days of portfolio values.
-    historical_chart_data = {}
+    # Retrieve price data once; it feeds both the chart and the current prices.
+    price_df = None
     if stock_codes:
         try:
             price_df = get_price_data(stock_codes)
-            if price_df.empty:
-                historical_chart_data = {"dates": [], "values": []}
-            else:
-                pivot = price_df.pivot(index='date', columns='ticker', values='close').fillna(0)
-                shares_dict = {stock.name: stock.shares for stock in stocks}
-                pivot["portfolio_value"] = pivot.apply(
-                    lambda row: sum(row.get(ticker, 0) * shares_dict.get(ticker, 0) for ticker in stock_codes), axis=1)
-                chart_df = pivot.sort_index(ascending=False).head(15).sort_index()
-                historical_chart_data = {
-                    "dates": chart_df.index.astype(str).tolist(),
-                    "values": chart_df["portfolio_value"].tolist()
-                }
-        except Exception as e:
-            print("Error retrieving historical price data:", e)
+        except Exception:
+            logger.exception("Error retrieving price data")
+
+    # Prepare historical chart data: last 15 days of portfolio values.
+    historical_chart_data = {"dates": [], "values": []}
+    if price_df is not None and not price_df.empty:
+        try:
+            pivot = price_df.pivot(index='date', columns='ticker', values='close').fillna(0).sort_index()
+            shares_dict = {stock.name: stock.shares or 0 for stock in stocks}
+            # Align share counts with the pivot columns and compute values in one dot product
+            weights = pd.Series(shares_dict, dtype=float).reindex(pivot.columns, fill_value=0)
+            pivot["portfolio_value"] = pivot.values @ weights.values
+            chart_df = pivot.tail(15)
+            historical_chart_data = {
+                "dates": chart_df.index.astype(str).tolist(),
+                "values": chart_df["portfolio_value"].tolist()
+            }
+        except Exception:
+            logger.exception("Error retrieving historical price data")
             historical_chart_data = {"dates": [], "values": []}
-    else:
-        historical_chart_data = {"dates": [], "values": []}
     
     # Retrieve current prices and Day-over-Day (DoD) changes.
     current_prices = {}
     day_over_day_change = {}
-    if stock_codes:
+    if price_df is not None:
         try:
-            price_df = get_price_data(stock_codes)
-            for ticker, group in price_df.groupby("ticker"):
-                group = group.sort_values("date")
-                if len(group) >= 2:
-                    prev = group.iloc[-2]["close"]
-                    curr = group.iloc[-1]["close"]
-                    current_prices[ticker] = curr
-                    day_over_day_change[ticker] = ((curr - prev) / prev) * 100
-                else:
-                    current_prices[ticker] = group.iloc[-1]["close"]
-                    day_over_day_change[ticker] = 0
-        except Exception as e:
-            print("Error retrieving current prices:", e)
+            # Last two closes per ticker as columns 0 (previous) and 1 (latest)
+            last2 = price_df.sort_values(["ticker", "date"]).groupby("ticker").tail(2)
+            last2 = last2.assign(position=last2.groupby("ticker").cumcount())
+            closes = last2.pivot(index="ticker", columns="position", values="close").reindex(columns=[0, 1])
+            prev = closes[0]
+            curr = closes[1].fillna(prev)  # Tickers with a single price have no change
+            current_prices = curr.to_dict()
+            day_over_day_change = ((curr - prev) / prev * 100).fillna(0).to_dict()
+        except Exception:
+            logger.exception("Error retrieving current prices")
     
     # Fetch news for stocks
     news_items = []
@@ -274,13 +326,13 @@ def dashboard():
         try:
             finlight_api_key = app.config['FINLIGHT_API_KEY']
             if finlight_api_key:
-                print(f"Fetching news for stock codes: {stock_codes}")
+                logger.debug("Fetching news for stock codes: %s", stock_codes)
                 news_items = get_stock_news(stock_codes, finlight_api_key)
-                print(f"Found {len(news_items)} news items")
+                logger.debug("Found %d news items", len(news_items))
             else:
-                print("Warning: FINLIGHT_API_KEY is not set in environment variables")
-        except Exception as e:
-            print("Error fetching news:", e)
+                logger.warning("FINLIGHT_API_KEY is not set in environment variables")
+        except Exception:
+            logger.exception("Error fetching news")
     
     now = datetime.now()
     
@@ -311,9 +363,6 @@ def settings():
     existing_stocks = Stock.query.filter_by(user_id=user_id).all()
     
     if request.method == 'POST':
-        # Delete all existing stocks for this user
-        Stock.query.filter_by(user_id=user_id).delete()
-        
         # Process updated stocks
         stocks = request.form.getlist('stock')
         shares = request.form.getlist('share')
@@ -331,15 +380,28 @@ def settings():
                 else:
                     stock_dict[stock_name] = share_count
 
-        # Delete original data
-        Stock.query.filter_by(user_id=user_id).delete()
+        # Upsert against the stocks already loaded above instead of delete-and-reinsert
+        stocks_by_name = {}
+        for stock in existing_stocks:
+            if stock.name in stock_dict and stock.name not in stocks_by_name:
+                stocks_by_name[stock.name] = stock
+            else:
+                db.session.delete(stock)  # removed from the form (or a duplicate row)
 
         # Updating users' stock list
+        new_rows = []
         for stock_name, total_shares in stock_dict.items():
-            new_stock = Stock(user_id=user_id, name=stock_name, shares=total_shares)
-            db.session.add(new_stock)
+            if stock_name in stocks_by_name:
+                stocks_by_name[stock_name].shares = total_shares
+            else:
+                new_rows.append({'user_id': user_id, 'name': stock_name, 'shares': total_shares})
+
+        # Insert new stocks in one batch, skipping per-object unit-of-work overhead
+        if new_rows:
+            db.session.bulk_insert_mappings(Stock, new_rows)
         
         db.session.commit()
+        invalidate_portfolio_analysis(user_id)
         flash('Portfolio settings updated successfully')
         return redirect(url_for('dashboard'))
     
@@ -1,3 +1,13 @@
+import os
+import redis
+from dotenv import load_dotenv
 from flask_sqlalchemy import SQLAlchemy
 
+# Load environment variables from .env
+load_dotenv()
+
 db = SQLAlchemy()
+
+# Shared Redis client for cross-worker caches; None when REDIS_URL is not set
+REDIS_URL = os.environ.get("REDIS_URL")
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
@@ -12,7 +12,7 @@ class UserProfile(db.Model):
     __bind_key__ = 'profile'
     id = db.Column(db.Integer, primary_key=True)
     # Removed ForeignKey constraint; store the user_id as an integer.
-    user_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
     age = db.Column(db.Integer)
     income_level = db.Column(db.String(50))
     budget = db.Column(db.Float)
@@ -26,14 +26,17 @@ class Portfolio(db.Model):
     __bind_key__ = 'profile'
     id = db.Column(db.Integer, primary_key=True)
     # Removed ForeignKey constraint here as well.
-    user_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
     # Define additional columns as needed
 
 class Stock(db.Model):
     __bind_key__ = 'profile'
+    __table_args__ = (
+        db.Index('ix_stock_user_name', 'user_id', 'name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     # Removed ForeignKey constraint here.
-    user_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
     name = db.Column(db.String(50))
     shares = db.Column(db.Integer)
     # Add any additional fields if needed
\ No newline at end of file
@@ -1,36 +1,194 @@
 import os
-import json
+import logging
+import orjson
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import time
+from types import MappingProxyType
+from extensions import redis_client
+
+logger = logging.getLogger(__name__)
 
 # Define the cache file path
 CACHE_FILE = os.path.join(os.path.dirname(__file__), 'news_cache.json')
 CACHE_TTL = 3600  # 1 hour
+MAX_CACHE_ENTRIES = 500  # Upper bound on tickers kept in the file cache
+MAX_WORKERS = 8  # Concurrent Finlight requests
+FINLIGHT_ARTICLES_URL = "https://api.finlight.me/v1/articles/extended"
+
+# Search-term mapping: Singapore stocks (with .SI), US stocks, ETFs, and Cryptocurrencies.
+_STOCK_MAPPING = MappingProxyType({
+    # Singapore Stocks (with .SI)
+    'Z74.SI': 'Singtel Singapore',
+    'CC3.SI': 'StarHub Singapore',
+    'C6L.SI': 'Singapore Airlines',
+    '9CI.SI': 'CapitaLand Group',
+    'D05.SI': 'DBS Bank Singapore',
+    'O39.SI': 'OCBC Singapore',
+    'U11.SI': 'UOB Singapore',
+    'C52.SI': 'ComfortDelGro Singapore',
+    'S63.SI': 'Singapore Technologies Engineering',
+    'U96.SI': 'Sembcorp Industries Singapore',
+    
+    # US Stocks
+    'AAPL': 'Apple',
+    'MSFT': 'Microsoft',
+    'GOOGL': 'Alphabet',
+    'AMZN': 'Amazon',
+    'TSLA': 'Tesla',
+    'NVDA': 'Nvidia',
+    'META': 'Meta',
+    'NFLX': 'Netflix',
+    'BABA': 'Alibaba',
+    'JPM': 'JPMorgan Chase',
+    'V': 'Visa',
+    'DIS': 'Disney',
+    'PEP': 'PepsiCo',
+    'NKE': 'Nike',
+    'UNH': 'UnitedHealth',
+    'BAC': 'Bank of America',
+    'KO': 'Coca-Cola',
+    'CSCO': 'Cisco',
+    'ADBE': 'Adobe',
+    'INTC': 'Intel',
+    'CRM': 'Salesforce',
+    'T': 'AT&T',
+    'XOM': 'ExxonMobil',
+    'PFE': 'Pfizer',
+    'ORCL': 'Oracle',
+    'WMT': 'Walmart',
+    'MCD': "McDonald's",
+    'PYPL': 'PayPal',
+    'COST': 'Costco',
+    'HON': 'Honeywell',
+    
+    # ETFs
+    'SPY': 'SPDR S&P 500 ETF Trust',
+    'IVV': 'iShares Core S&P 500 ETF',
+    'VTI': 'Vanguard Total Stock Market ETF',
+    'VOO': 'Vanguard S&P 500 ETF',
+    'QQQ': 'Invesco QQQ Trust',
+    'ARKK': 'ARK Innovation ETF',
+    'EFA': 'iShares MSCI EAFE ETF',
+    'EEM': 'iShares MSCI Emerging Markets ETF',
+    'BND': 'Vanguard Total Bond Market ETF',
+    'AGG': 'iShares Core U.S. Aggregate Bond ETF',
+    
+    # Cryptocurrencies
+    'bitcoin': 'Bitcoin',
+    'ethereum': 'Ethereum',
+    'solana': 'Solana',
+    'ripple': 'Ripple',
+    'cardano': 'Cardano',
+    'polkadot': 'Polkadot',
+    'litecoin': 'Litecoin',
+    'avalanche-2': 'Avalanche',
+    'dogecoin': 'Dogecoin',
+    'chainlink': 'Chainlink'
+})
+
+# Shared keep-alive HTTP session so TCP/TLS connections to Finlight are reused,
+# with retries to smooth over transient rate limiting and gateway errors
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+))
 
 def load_cache():
     """Load the cache from a JSON file."""
     if os.path.exists(CACHE_FILE):
         try:
-            with open(CACHE_FILE, 'r') as f:
-                return json.load(f)
+            with open(CACHE_FILE, 'rb') as f:
+                return orjson.loads(f.read())
         except Exception as e:
-            print(f"Error loading cache: {e}")
+            logger.warning("Error loading cache: %s", e)
     return {}
 
 def save_cache(cache):
-    """Save the cache to a JSON file."""
+    """Atomically save the cache to a JSON file."""
+    tmp_file = f"{CACHE_FILE}.{os.getpid()}.tmp"
     try:
-        with open(CACHE_FILE, 'w') as f:
-            json.dump(cache, f)
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(cache))
+        os.replace(tmp_file, CACHE_FILE)
     except Exception as e:
-        print(f"Error saving cache: {e}")
+        logger.warning("Error saving cache: %s", e)
+
+# In-process cache, loaded from disk once and persisted only when it changes.
+# Used when Redis is not configured.
+_CACHE = {} if redis_client else load_cache()
+_cache_lock = threading.Lock()
+
+def _get_cached(cache_keys, now, page_size):
+    """
+    Return {cache_key: articles} for every fresh entry among cache_keys that was
+    fetched with at least page_size articles, trimmed to page_size.
+    """
+    if redis_client:
+        try:
+            values = redis_client.mget(cache_keys)
+        except Exception as e:
+            logger.warning("Error reading news cache from Redis: %s", e)
+            return {}
+        entries = {key: orjson.loads(value) for key, value in zip(cache_keys, values) if value is not None}
+    else:
+        entries = {}
+        with _cache_lock:
+            for cache_key in cache_keys:
+                entry = _CACHE.get(cache_key)
+                if entry and now - entry.get('timestamp', 0) < CACHE_TTL:
+                    entries[cache_key] = entry
+
+    return {
+        cache_key: entry['articles'][:page_size]
+        for cache_key, entry in entries.items()
+        if 'articles' in entry and entry.get('page_size', 0) >= page_size
+    }
+
+def _update_cache(entries, timestamp, page_size):
+    """Store per-ticker article lists in Redis, or in memory and on disk."""
+    if redis_client:
+        try:
+            pipe = redis_client.pipeline()
+            for cache_key, articles in entries.items():
+                pipe.setex(cache_key, CACHE_TTL, orjson.dumps({'page_size': page_size, 'articles': articles}))
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Error writing news cache to Redis: %s", e)
+        return
+
+    with _cache_lock:
+        # Pick up entries other workers wrote since we loaded, so saving doesn't drop them
+        for cache_key, entry in load_cache().items():
+            if entry.get('timestamp', 0) > _CACHE.get(cache_key, {}).get('timestamp', 0):
+                _CACHE[cache_key] = entry
+        for cache_key, articles in entries.items():
+            _CACHE[cache_key] = {'timestamp': timestamp, 'page_size': page_size, 'articles': articles}
+
+        # Drop expired entries and keep only the newest MAX_CACHE_ENTRIES
+        live = sorted(
+            ((key, entry) for key, entry in _CACHE.items()
+             if timestamp - entry.get('timestamp', 0) < CACHE_TTL),
+            key=lambda item: item[1].get('timestamp', 0),
+            reverse=True
+        )
+        _CACHE.clear()
+        _CACHE.update(live[:MAX_CACHE_ENTRIES])
+        save_cache(_CACHE)
 
 def get_stock_news(stock_codes, api_key, days_back=7, max_results=5, language="en"):
     """
     Fetch news related to specific stocks from the Finlight API.
     
-    This version uses a file-based JSON cache to improve performance.
+    Articles are cached per ticker in Redis when REDIS_URL is set (shared by all
+    workers), otherwise in memory and persisted to a JSON file on change, so
+    portfolios that share tickers reuse each other's results.
     
     Args:
         stock_codes (list): List of stock codes to fetch news for.
@@ -42,137 +200,63 @@ def get_stock_news(stock_codes, api_key, days_back=7, max_results=5, language="e
     Returns:
         list: List of news items (with duplicate titles omitted).
     """
-    cache_key = f"{','.join(sorted(stock_codes))}_{days_back}_{max_results}_{language}"
     now = time.time()
+    # Spread max_results across tickers so the total payload stays bounded
+    page_size = min(max_results, max(2, max_results // max(1, len(stock_codes)) + 1))
+    # Page size is left out of the key; an entry fetched with a larger page serves smaller ones
+    cache_keys = {code: f"news:{code}_{days_back}_{language}" for code in dict.fromkeys(stock_codes)}
     
-    # Load existing cache from file.
-    cache = load_cache()
+    # Collect fresh cached articles and the tickers that still need fetching
+    cached = _get_cached(list(cache_keys.values()), now, page_size)
+    missing_codes = [code for code, cache_key in cache_keys.items() if cache_key not in cached]
     
-    if cache_key in cache:
-        entry = cache[cache_key]
-        if now - entry.get('timestamp', 0) < CACHE_TTL:
-            return entry.get('data', [])
-    
-    # Updated mapping: include Singapore stocks (with .SI), US stocks, ETFs, and Cryptocurrencies.
-    stock_mapping = {
-        # Singapore Stocks (with .SI)
-        'Z74.SI': 'Singtel Singapore',
-        'CC3.SI': 'StarHub Singapore',
-        'C6L.SI': 'Singapore Airlines',
-        '9CI.SI': 'CapitaLand Group',
-        'D05.SI': 'DBS Bank Singapore',
-        'O39.SI': 'OCBC Singapore',
-        'U11.SI': 'UOB Singapore',
-        'C52.SI': 'ComfortDelGro Singapore',
-        'S63.SI': 'Singapore Technologies Engineering',
-        'U96.SI': 'Sembcorp Industries Singapore',
-        
-        # US Stocks
-        'AAPL': 'Apple',
-        'MSFT': 'Microsoft',
-        'GOOGL': 'Alphabet',
-        'AMZN': 'Amazon',
-        'TSLA': 'Tesla',
-        'NVDA': 'Nvidia',
-        'META': 'Meta',
-        'NFLX': 'Netflix',
-        'BABA': 'Alibaba',
-        'JPM': 'JPMorgan Chase',
-        'V': 'Visa',
-        'DIS': 'Disney',
-        'PEP': 'PepsiCo',
-        'NKE': 'Nike',
-        'UNH': 'UnitedHealth',
-        'BAC': 'Bank of America',
-        'KO': 'Coca-Cola',
-        'CSCO': 'Cisco',
-        'ADBE': 'Adobe',
-        'INTC': 'Intel',
-        'CRM': 'Salesforce',
-        'T': 'AT&T',
-        'XOM': 'ExxonMobil',
-        'PFE': 'Pfizer',
-        'ORCL': 'Oracle',
-        'WMT': 'Walmart',
-        'MCD': "McDonald's",
-        'PYPL': 'PayPal',
-        'COST': 'Costco',
-        'HON': 'Honeywell',
-        
-        # ETFs
-        'SPY': 'SPDR S&P 500 ETF Trust',
-        'IVV': 'iShares Core S&P 500 ETF',
-        'VTI': 'Vanguard Total Stock Market ETF',
-        'VOO': 'Vanguard S&P 500 ETF',
-        'QQQ': 'Invesco QQQ Trust',
-        'ARKK': 'ARK Innovation ETF',
-        'EFA': 'iShares MSCI EAFE ETF',
-        'EEM': 'iShares MSCI Emerging Markets ETF',
-        'BND': 'Vanguard Total Bond Market ETF',
-        'AGG': 'iShares Core U.S. Aggregate Bond ETF',
+    if missing_codes:
+        end_date = datetime.now()
+        start_date = end_date - timedelta(days=days_back)
+        start_date_str = start_date.strftime('%Y-%m-%d')
+        end_date_str = end_date.strftime('%Y-%m-%d')
         
-        # Cryptocurrencies
-        'bitcoin': 'Bitcoin',
-        'ethereum': 'Ethereum',
-        'solana': 'Solana',
-        'ripple': 'Ripple',
-        'cardano': 'Cardano',
-        'polkadot': 'Polkadot',
-        'litecoin': 'Litecoin',
-        'avalanche-2': 'Avalanche',
-        'dogecoin': 'Dogecoin',
-        'chainlink': 'Chainlink'
-    }
-    
-    search_terms = []
-    stock_names = []
-    for code in stock_codes:
-        if code in stock_mapping:
-            search_terms.append(stock_mapping[code])
-            stock_names.append(stock_mapping[code])
-        else:
-            search_terms.append(code)
-            stock_names.append(code)
-    
-    if not search_terms:
-        cache[cache_key] = {'timestamp': now, 'data': []}
-        save_cache(cache)
-        return []
-    
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=days_back)
-    start_date_str = start_date.strftime('%Y-%m-%d')
-    end_date_str = end_date.strftime('%Y-%m-%d')
-    
-    base_url = "https://api.finlight.me/v1/articles/extended"
-    headers = {
-        "accept": "application/json",
-        "X-API-KEY": api_key
-    }
-    
-    all_news = []
-    
-    for i, search_term in enumerate(search_terms):
-        params = {
-            "query": search_term,
-            "from": start_date_str,
-            "to": end_date_str,
-            "language": language,
-            "pageSize": max_results
+        headers = {
+            "accept": "application/json",
+            "X-API-KEY": api_key
         }
-        try:
-            response = requests.get(base_url, headers=headers, params=params)
-            response.raise_for_status()
-            data = response.json()
-            
-            if 'articles' in data:
-                for article in data['articles']:
-                    article['stock_name'] = stock_names[i]
-                    all_news.append(article)
-        except Exception as e:
-            print(f"Error fetching news for {search_term}: {e}")
-            continue
+        
+        def fetch(code):
+            # The search term doubles as the display name attached to each article
+            search_term = _STOCK_MAPPING.get(code, code)
+            params = {
+                "query": search_term,
+                "from": start_date_str,
+                "to": end_date_str,
+                "language": language,
+                "pageSize": page_size
+            }
+            try:
+                response = _session.get(FINLIGHT_ARTICLES_URL, headers=headers, params=params, timeout=10)
+                response.raise_for_status()
+                articles = response.json().get('articles', [])
+            except Exception as e:
+                logger.warning("Error fetching news for %s: %s", search_term, e)
+                return None
+            for article in articles:
+                article['stock_name'] = search_term
+            return articles
 
+        # Fetch missing tickers concurrently; results come back in input order
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(missing_codes))) as executor:
+            results = list(executor.map(fetch, missing_codes))
+
+        # Only successful fetches are cached so failures are retried next time
+        fetched = {}
+        for code, articles in zip(missing_codes, results):
+            if articles is not None:
+                fetched[cache_keys[code]] = articles
+        if fetched:
+            cached.update(fetched)
+            _update_cache(fetched, now, page_size)
+
+    # Merge in stock_codes order so the stock_name kept for duplicate titles is stable
+    all_news = [article for cache_key in cache_keys.values() for article in cached.get(cache_key, [])]
     all_news.sort(key=lambda x: x.get('publishDate', ''), reverse=True)
     
     seen_titles = set()
@@ -183,9 +267,4 @@ def get_stock_news(stock_codes, api_key, days_back=7, max_results=5, language="e
             unique_news.append(article)
             seen_titles.add(title)
     
-    final_news = unique_news[:max_results]
-    
-    cache[cache_key] = {'timestamp': now, 'data': final_news}
-    save_cache(cache)
-    
-    return final_news
+    return unique_news[:max_results]
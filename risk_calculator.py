@@ -1,9 +1,17 @@
 import os
-import psycopg2
+import logging
+import pickle
+import hashlib
+import threading
+from psycopg_pool import ConnectionPool
 import pandas as pd
 import numpy as np
 from math import sqrt
+from datetime import date, timedelta
 from dotenv import load_dotenv
+from extensions import redis_client
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env
 load_dotenv()
@@ -28,63 +36,218 @@ DB_SETTINGS_STOCK = {
     "sslmode": "require"
 }
 
+PRICE_CACHE_TTL = 3600  # Cache per-ticker price history for 1 hour (in seconds)
+RETURNS_CACHE_TTL = 3600  # Cache derived returns and covariance for 1 hour (in seconds)
+ANALYSIS_CACHE_TTL = 3600  # Cache analyze_portfolio results for 1 hour (in seconds)
+MIN_LOOKBACK_DAYS = 2 * 365  # Use at least two years of history for risk estimates
+
+# Connection pools shared by all requests in a process. psycopg_pool runs background
+# worker threads, which do not survive fork(), so each process (gunicorn worker,
+# Celery prefork child) builds and opens its own pools on first use rather than at
+# import. Connections are opened lazily (min_size=0).
+# prepare_threshold=1 makes psycopg prepare each query server-side after its first run.
+_POOL_SETTINGS = {
+    "profile": DB_SETTINGS_PROFILE,
+    "stock": DB_SETTINGS_STOCK
+}
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+def get_pool(name):
+    """
+    Return this process's connection pool for the "profile" or "stock" database.
+    """
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # Pools inherited from a parent process have dead worker threads
+            _pools.clear()
+            _pools_pid = os.getpid()
+        if name not in _pools:
+            _pools[name] = ConnectionPool(
+                kwargs={**_POOL_SETTINGS[name], "prepare_threshold": 1},
+                min_size=0, max_size=16, open=False
+            )
+            _pools[name].open()
+        return _pools[name]
+
 # --------------------- Data Retrieval Functions --------------------- #
-def get_user_profile(user_id):
+def get_user_portfolio(user_id):
     """
-    Retrieve the user profile details for a given user_id from the credentials database.
+    Retrieve the user's profile and stock portfolio from the credentials database
+    in a single round-trip. The stocks are aggregated into a JSON array column.
     """
-    conn = psycopg2.connect(**DB_SETTINGS_PROFILE)
     query = """
-        SELECT budget, risk_percentage, term_length, term_type 
-        FROM user_profile 
-        WHERE user_id = %s;
+        SELECT p.budget, p.risk_percentage, p.term_length, p.term_type,
+               (SELECT COALESCE(json_agg(json_build_object('name', s.name, 'shares', s.shares)), '[]'::json)
+                FROM stock s
+                WHERE s.user_id = p.user_id) AS stocks
+        FROM user_profile p
+        WHERE p.user_id = %s;
     """
-    df = pd.read_sql(query, conn, params=[user_id])
-    conn.close()
-    if df.empty:
+    with get_pool("profile").connection() as conn:
+        with conn.cursor(binary=True) as cur:
+            cur.execute(query, (user_id,))
+            row = cur.fetchone()
+    if row is None:
         raise ValueError(f"No profile found for user_id {user_id}")
-    return df.iloc[0]
 
-def get_user_stocks(user_id):
+    budget, risk_percentage, term_length, term_type, stocks = row
+    profile = pd.Series({
+        "budget": budget,
+        "risk_percentage": risk_percentage,
+        "term_length": term_length,
+        "term_type": term_type
+    })
+    portfolio = pd.DataFrame(stocks, columns=["name", "shares"])
+    return profile, portfolio
+
+def _fetch_price_data(tickers, lookback_days=None):
     """
-    Retrieve the user's stock portfolio from the credentials database.
+    Query historical price data for the specified tickers from the stock data database,
+    optionally limited to the last lookback_days calendar days.
     """
-    conn = psycopg2.connect(**DB_SETTINGS_PROFILE)
-    query = "SELECT name, shares FROM stock WHERE user_id = %s;"
-    df = pd.read_sql(query, conn, params=[user_id])
-    conn.close()
-    return df
+    params = [list(tickers)]
+    date_filter = ""
+    if lookback_days is not None:
+        date_filter = " AND date >= %s"
+        params.append(date.today() - timedelta(days=lookback_days))
+    # Binary COPY skips text parsing on both ends; the casts pin the column types
+    # so the binary loaders below always match. COPY cannot take server-side
+    # parameters, so psycopg inlines them as literals: the statement text varies
+    # with the ticker set and day and is never prepared, unlike the other queries here.
+    query = f"""
+        COPY (
+            SELECT date::timestamp, ticker::text, close::float8
+            FROM prices
+            WHERE ticker = ANY(%s){date_filter}
+            ORDER BY date ASC
+        ) TO STDOUT (FORMAT BINARY)
+    """
+    with get_pool("stock").connection() as conn:
+        with conn.cursor() as cur:
+            with cur.copy(query, params) as copy:
+                copy.set_types(["timestamp", "text", "float8"])
+                price_df = pd.DataFrame.from_records(copy.rows(), columns=["date", "ticker", "close"])
+
+    if price_df.empty:
+        return pd.DataFrame({
+            "date": pd.Series(dtype="datetime64[ns]"),
+            "ticker": pd.Series(dtype=object),
+            "close": pd.Series(dtype=np.float64)
+        })
+    return price_df
 
-def get_price_data(tickers):
+def get_latest_prices(tickers):
     """
-    Retrieve historical price data for the specified tickers from the stock data database.
+    Retrieve the most recent closing price for each ticker as a {ticker: close} dict.
     """
-    conn = psycopg2.connect(**DB_SETTINGS_STOCK)
-    placeholders = ', '.join(['%s'] * len(tickers))
-    query = f"SELECT date, ticker, close FROM prices WHERE ticker IN ({placeholders}) ORDER BY date ASC;"
-    df = pd.read_sql(query, conn, params=tickers)
-    conn.close()
-    return df
+    query = """
+        SELECT DISTINCT ON (ticker) ticker, close
+        FROM prices
+        WHERE ticker = ANY(%s) AND close IS NOT NULL
+        ORDER BY ticker, date DESC;
+    """
+    with get_pool("stock").connection() as conn:
+        with conn.cursor(binary=True) as cur:
+            cur.execute(query, (list(tickers),))
+            return {ticker: float(close) for ticker, close in cur.fetchall()}
+
+def get_price_data(tickers, lookback_days=None):
+    """
+    Retrieve historical price data for the specified tickers. If lookback_days is given,
+    only prices from the last lookback_days calendar days are returned.
+    When Redis is configured, each ticker's history is cached so only misses hit the database.
+    """
+    if not redis_client or not tickers:
+        return _fetch_price_data(tickers, lookback_days)
+
+    window = lookback_days if lookback_days is not None else "all"
+    try:
+        cached = redis_client.mget([f"prices:{t}:{window}" for t in tickers])
+    except Exception as e:
+        logger.warning("Error reading price cache from Redis: %s", e)
+        return _fetch_price_data(tickers, lookback_days)
+
+    frames = [pickle.loads(value) for value in cached if value is not None]
+    missing = [t for t, value in zip(tickers, cached) if value is None]
+    if missing:
+        fetched = _fetch_price_data(missing, lookback_days)
+        frames.append(fetched)
+        try:
+            pipe = redis_client.pipeline()
+            for ticker, group in fetched.groupby("ticker"):
+                pipe.setex(f"prices:{ticker}:{window}", PRICE_CACHE_TTL, pickle.dumps(group, protocol=pickle.HIGHEST_PROTOCOL))
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Error writing price cache to Redis: %s", e)
+
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values("date", kind="stable").reset_index(drop=True)
 
 # --------------------- Calculation Functions --------------------- #
-def calculate_portfolio_returns(price_df, weights, tickers):
-    pivot = price_df.pivot(index='date', columns='ticker', values='close')
-    daily_returns = pivot.pct_change().dropna()
+def calculate_returns_and_covariance(price_df, weights, tickers):
+    """
+    Build the daily returns matrix, the weighted portfolio returns and the returns
+    covariance in a single pass with NumPy.
+    Returns (daily_returns, portfolio_returns, cov_matrix) where daily_returns is a
+    (T, K) array whose columns follow the order of tickers, which weights must already match.
+    """
+    column_idx = {t: i for i, t in enumerate(tickers)}
+
+    # Scatter closes into a (dates x tickers) matrix instead of DataFrame.pivot
+    dates, date_idx = np.unique(price_df['date'].to_numpy(), return_inverse=True)
+    ticker_idx = price_df['ticker'].map(column_idx).to_numpy(dtype=np.intp)
+    prices = np.full((len(dates), len(tickers)), np.nan)
+    prices[date_idx, ticker_idx] = price_df['close'].to_numpy(dtype=np.float64)
+
+    # Forward-fill gaps using the index of the last valid row in each column
+    last_valid = np.where(np.isnan(prices), 0, np.arange(len(dates))[:, None])
+    np.maximum.accumulate(last_valid, axis=0, out=last_valid)
+    prices = prices[last_valid, np.arange(len(tickers))]
+
+    # Daily returns, dropping rows where any ticker has no price yet. float32 is ample
+    # precision for returns and halves the memory traffic of the matmuls that follow.
+    daily_returns = prices[1:] / prices[:-1] - 1
+    daily_returns = daily_returns[~np.isnan(daily_returns).any(axis=1)].astype(np.float32)
+
+    portfolio_returns = daily_returns @ np.asarray(weights, dtype=np.float32)
+
+    # Sample covariance from X^T X and the column means, avoiding a centered (T, K) copy
+    n_days = daily_returns.shape[0]
+    mean_returns = daily_returns.mean(axis=0)
+    cov_matrix = (daily_returns.T @ daily_returns) / (n_days - 1) \
+        - (n_days / (n_days - 1)) * np.outer(mean_returns, mean_returns)
 
-    # Ensure weights are aligned with the pivot's column order
-    weights_series = pd.Series(weights, index=tickers)
-    weights_aligned = weights_series[pivot.columns]
+    return daily_returns, portfolio_returns, cov_matrix
 
-    portfolio_returns = daily_returns.dot(weights_aligned)
-    return daily_returns, portfolio_returns
 
+def _risk_core(returns):
+    """
+    Return (population std, 5th percentile) of a returns vector in one call.
+    The sum of squares is a single dot product instead of square-then-sum temporaries,
+    and the percentile uses a partial partition instead of a full sort.
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    centered = returns - returns.mean()
+    std = sqrt(centered @ centered / len(returns))
+
+    # 5th percentile via introselect (O(n)) with the same linear interpolation as np.percentile
+    position = 0.05 * (len(returns) - 1)
+    k = int(position)
+    if k + 1 < len(returns):
+        lower, upper = np.partition(returns, [k, k + 1])[k:k + 2]
+        var_95 = lower + (upper - lower) * (position - k)
+    else:
+        var_95 = np.partition(returns, k)[k]
+    return std, var_95
 
 def calculate_risk_metrics(weighted_returns, portfolio_value, risk_amount, term_length, term_type):
     """
     Compute volatility and VaR metrics for the portfolio and assign a risk score.
     """
-    daily_vol = np.std(weighted_returns)
-    var_95 = np.percentile(weighted_returns, 5)
+    daily_vol, var_95 = _risk_core(weighted_returns)
     var_1d = -var_95 * portfolio_value
 
     days = int(term_length) * 30
@@ -106,65 +269,109 @@ def calculate_risk_metrics(weighted_returns, portfolio_value, risk_amount, term_
         "investment_horizon_days": days
     }
 
-def calculate_risk_contributions(daily_returns, weights, tickers):
+def calculate_risk_contributions(cov_matrix, weights, tickers):
     """
     Calculate risk contributions from each asset in the portfolio.
+    cov_matrix comes from calculate_returns_and_covariance, with rows, columns
+    and weights in the order of tickers.
     """
-    cov_matrix = daily_returns.cov()
-
-    
-    portfolio_std = np.sqrt(np.dot(weights, np.dot(cov_matrix, weights)))
-    marginal_contributions = np.dot(cov_matrix, weights) / portfolio_std
-    vol_contributions = weights * marginal_contributions
-    percent_contributions = vol_contributions / portfolio_std
-
-    # Align weights with ticker names from daily_returns.columns
-    weights_series = pd.Series(weights, index=tickers)
-    weights_aligned = weights_series[daily_returns.columns]
+    # Do the math in the covariance dtype; the reported weights stay untouched
+    w = np.asarray(weights, dtype=cov_matrix.dtype)
 
     # Risk contribution
-    portfolio_std = np.sqrt(np.dot(weights_aligned, np.dot(cov_matrix, weights_aligned)))
-    marginal_contributions = np.dot(cov_matrix, weights_aligned) / portfolio_std
-    vol_contributions = weights_aligned * marginal_contributions
+    portfolio_std = np.sqrt(np.dot(w, np.dot(cov_matrix, w)))
+    marginal_contributions = np.dot(cov_matrix, w) / portfolio_std
+    vol_contributions = w * marginal_contributions
     percent_contributions = vol_contributions / portfolio_std
 
     contribution_df = pd.DataFrame({
-        'Ticker': daily_returns.columns,
-        'Weight': weights_aligned.values,
-        'Risk_Contribution': percent_contributions * 100
+        'Ticker': tickers,
+        'Weight': np.asarray(weights, dtype=np.float64),
+        'Risk_Contribution': percent_contributions.astype(np.float64) * 100
     })
 
     return contribution_df
 
 # --------------------- Aggregation & Recommendation Functions --------------------- #
+def _returns_cache_key(tickers, lookback_days):
+    """
+    Build the cache key for the returns matrix of an ordered ticker set and lookback window.
+    """
+    digest = hashlib.sha1(",".join(tickers).encode()).hexdigest()
+    return f"returns:{digest}:{lookback_days}:{date.today().isoformat()}"
+
+def _analysis_cache_key(user_id, profile, portfolio):
+    """
+    Build the analysis cache key from the user, the trading day, and a hash of the
+    profile and holdings, so editing either one naturally misses the cache.
+    (tasks.py keeps the latest result per user under dashboard_analysis:* on top of this.)
+    """
+    state = repr((profile.tolist(), portfolio.values.tolist()))
+    digest = hashlib.sha1(state.encode()).hexdigest()
+    return f"analyze:{user_id}:{date.today().isoformat()}:{digest}"
+
 def analyze_portfolio(user_id):
     """
     Aggregate portfolio data, calculate risk metrics, and generate insights and recommendations.
     Returns a dictionary with all results.
     """
     # Data retrieval from the credentials database
-    profile = get_user_profile(user_id)
-    portfolio = get_user_stocks(user_id)
+    profile, portfolio = get_user_portfolio(user_id)
+
+    # Fix a canonical ticker order up front so weights line up with the returns columns
+    portfolio = portfolio.iloc[np.argsort(portfolio['name'].to_numpy(), kind='stable')].reset_index(drop=True)
+
+    # Results only change with the portfolio or the day's prices, so reuse a cached result
+    cache_key = _analysis_cache_key(user_id, profile, portfolio)
+    if redis_client:
+        try:
+            cached = redis_client.get(cache_key)
+            if cached is not None:
+                return pickle.loads(cached)
+        except Exception as e:
+            logger.warning("Error reading analysis cache from Redis: %s", e)
+
     tickers = portfolio['name'].tolist()
     shares = portfolio['shares'].astype(float).tolist()
+    shares_dict = dict(zip(tickers, portfolio['shares'].tolist()))
     risk_amount = profile['budget'] * profile['risk_percentage']
 
-    # Retrieve price data from the stock database
-    prices = get_price_data(tickers)
-    if prices.empty:
-        raise ValueError("No price data available for these tickers.")
-
     # Get the latest price for each ticker
-    latest_prices = prices.sort_values("date").groupby("ticker").last().reset_index()
-    latest_dict = dict(zip(latest_prices["ticker"], latest_prices["close"]))
+    latest_dict = get_latest_prices(tickers)
 
     # Calculate weights based on current market values
-    weights_value = [latest_dict[t] * s for t, s in zip(tickers, shares)]
-    total_value = sum(weights_value)
-    weights = [v / total_value for v in weights_value]
-
-    # Calculate portfolio returns
-    daily_returns, weighted_returns = calculate_portfolio_returns(prices, weights, tickers)
+    latest_arr = np.fromiter((latest_dict[t] for t in tickers), dtype=np.float64, count=len(tickers))
+    values = latest_arr * np.asarray(shares, dtype=np.float64)
+    total_value = values.sum()
+    weights = values / total_value
+
+    # Price history is bounded to what the horizon needs
+    lookback_days = max(MIN_LOOKBACK_DAYS, int(profile['term_length']) * 30)
+
+    # The returns matrix depends only on the tickers and window, so reuse one built
+    # today by any worker; otherwise fetch prices and compute it in one pass
+    returns_key = _returns_cache_key(tickers, lookback_days)
+    cached_returns = None
+    if redis_client:
+        try:
+            cached_returns = redis_client.get(returns_key)
+        except Exception as e:
+            logger.warning("Error reading returns cache from Redis: %s", e)
+
+    if cached_returns is not None:
+        daily_returns, cov_matrix = pickle.loads(cached_returns)
+        weighted_returns = daily_returns @ weights.astype(daily_returns.dtype)
+    else:
+        prices = get_price_data(tickers, lookback_days)
+        if prices.empty:
+            raise ValueError("No price data available for these tickers.")
+        daily_returns, weighted_returns, cov_matrix = calculate_returns_and_covariance(prices, weights, tickers)
+        if redis_client:
+            try:
+                redis_client.setex(returns_key, RETURNS_CACHE_TTL,
+                                   pickle.dumps((daily_returns, cov_matrix), protocol=pickle.HIGHEST_PROTOCOL))
+            except Exception as e:
+                logger.warning("Error writing returns cache to Redis: %s", e)
 
 
     # Now calculate risk metrics
@@ -178,17 +385,19 @@ def analyze_portfolio(user_id):
 
 
     # Calculate risk contributions
-    contribution_df = calculate_risk_contributions(daily_returns, weights, tickers)
-    top_risk_drivers = contribution_df.sort_values(by='Risk_Contribution', ascending=False).head(3)
-    bottom_risk_drivers = contribution_df.sort_values(by='Risk_Contribution', ascending=True).head(3)
+    contribution_df = calculate_risk_contributions(cov_matrix, weights, tickers)
+    # Sort contributions once and reuse the order for the top/bottom views
+    risk_order = np.argsort(contribution_df['Risk_Contribution'].to_numpy(), kind='stable')
+    top_risk_drivers = contribution_df.iloc[risk_order[::-1][:3]]
+    bottom_risk_drivers = contribution_df.iloc[risk_order[:3]]
 
     # Portfolio breakdown data
     portfolio_breakdown = []
-    for t, s in zip(tickers, shares):
+    for t, s, value in zip(tickers, shares, values.tolist()):
         portfolio_breakdown.append({
             "Ticker": t,
             "Shares": int(s),
-            "Value_USD": latest_dict[t] * s
+            "Value_USD": value
         })
 
     # Generate insights
@@ -224,7 +433,7 @@ def analyze_portfolio(user_id):
         recommendations["investment_term"] = f"Reduce investment term to ~{recommended_days} days to meet your risk allowance."
         
         top_asset = top_risk_drivers.iloc[0]['Ticker']
-        current_units = portfolio[portfolio['name'] == top_asset]['shares'].values[0]
+        current_units = shares_dict[top_asset]
         top_asset_price = latest_dict[top_asset]
         top_asset_risk_pct = top_risk_drivers.iloc[0]['Risk_Contribution'] / 100
         top_asset_var_contribution = top_asset_risk_pct * risk_metrics["var_scaled"]
@@ -251,12 +460,14 @@ def analyze_portfolio(user_id):
         )
     elif risk_metrics["risk_score"] == "A":
         spare_risk = risk_amount - risk_metrics["var_scaled"]
-        positive_contributors = contribution_df[contribution_df["Risk_Contribution"] >= 0]
-        if not positive_contributors.empty:
-            potential_asset = positive_contributors.sort_values("Risk_Contribution").iloc[0]["Ticker"]
-            current_units = portfolio[portfolio["name"] == potential_asset]["shares"].values[0]
+        # Smallest non-negative contributor, found by walking the existing ascending order
+        ordered_contributions = contribution_df["Risk_Contribution"].to_numpy()[risk_order]
+        positive_positions = np.flatnonzero(ordered_contributions >= 0)
+        if positive_positions.size:
+            potential_asset = contribution_df["Ticker"].iloc[risk_order[positive_positions[0]]]
+            current_units = shares_dict[potential_asset]
             current_price = latest_dict[potential_asset]
-            risk_pct = contribution_df[contribution_df["Ticker"] == potential_asset]["Risk_Contribution"].values[0] / 100
+            risk_pct = ordered_contributions[positive_positions[0]] / 100
             contribution_to_var = risk_pct * risk_metrics["var_scaled"]
 
             if current_units > 0 and contribution_to_var > 0 and spare_risk > 0:
@@ -269,12 +480,12 @@ def analyze_portfolio(user_id):
             else:
                 recommendations["asset_adjustment"] = f"Consider allocating to {potential_asset}, but a safe unit suggestion could not be computed."
         else:
-            best_hedge = contribution_df.sort_values("Risk_Contribution").iloc[0]["Ticker"]
+            best_hedge = bottom_risk_drivers.iloc[0]["Ticker"]
             recommendations["asset_adjustment"] = (
                 f"All assets contribute negatively to portfolio risk. Consider {best_hedge} as a potential hedge."
             )
 
-    return {
+    result = {
         "portfolio_breakdown": portfolio_breakdown,
         "risk_metrics": risk_metrics,
         "risk_contributions": contribution_df,
@@ -283,4 +494,12 @@ def analyze_portfolio(user_id):
         "insights": insights,
         "recommendations": recommendations,
         "total_portfolio_value": total_value
-    }
\ No newline at end of file
+    }
+
+    if redis_client:
+        try:
+            redis_client.setex(cache_key, ANALYSIS_CACHE_TTL, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            logger.warning("Error writing analysis cache to Redis: %s", e)
+
+    return result
\ No newline at end of file
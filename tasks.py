@@ -0,0 +1,115 @@
+import os
+import logging
+import pickle
+from celery import Celery
+from extensions import redis_client
+from risk_calculator import analyze_portfolio
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_TTL = 3600  # Recompute risk analysis at most once an hour (in seconds)
+ANALYSIS_MAX_AGE = 86400  # Serve a stale result for up to a day while recomputing
+
+# Background recomputation needs a running worker, so it is opt-in via its own broker
+# URL; with only REDIS_URL set, expired results are recomputed on the request itself
+CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL")
+celery_app = Celery("tasks", broker=CELERY_BROKER_URL)
+
+
+# The latest dashboard result per user, served stale while a task refreshes it after expiry.
+# Distinct from risk_calculator's analyze:* keys, which memoize one analysis per
+# portfolio state and day and are what the task hits when nothing has changed.
+def _result_key(user_id):
+    return f"dashboard_analysis:{user_id}"
+
+
+def _fresh_key(user_id):
+    return f"dashboard_analysis_fresh:{user_id}"
+
+
+# Values of the freshness key
+_FRESH = b"fresh"
+_PENDING = b"pending"
+
+
+def store_portfolio_analysis(user_id):
+    """
+    Run analyze_portfolio for a user and store the result in Redis.
+    """
+    result = analyze_portfolio(user_id)
+    if redis_client:
+        try:
+            pipe = redis_client.pipeline()
+            pipe.setex(_result_key(user_id), ANALYSIS_MAX_AGE, pickle.dumps(result))
+            pipe.setex(_fresh_key(user_id), ANALYSIS_TTL, _FRESH)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Error caching portfolio analysis: %s", e)
+    return result
+
+
+def _clear_pending(user_id):
+    # Drop the pending marker so the next request can queue a new task
+    try:
+        redis_client.delete(_fresh_key(user_id))
+    except Exception as e:
+        logger.warning("Error clearing portfolio analysis status: %s", e)
+
+
+@celery_app.task
+def analyze_portfolio_task(user_id):
+    try:
+        store_portfolio_analysis(user_id)
+    except Exception:
+        _clear_pending(user_id)
+        raise
+
+
+def invalidate_portfolio_analysis(user_id):
+    """
+    Drop the user's cached risk analysis after their portfolio changes, so the next
+    dashboard load computes it afresh instead of showing the old holdings.
+    Does nothing when Redis is not configured.
+    """
+    if redis_client:
+        try:
+            redis_client.delete(_result_key(user_id), _fresh_key(user_id))
+        except Exception as e:
+            logger.warning("Error clearing cached portfolio analysis: %s", e)
+
+
+def get_portfolio_analysis(user_id):
+    """
+    Return the user's risk analysis, preferring the cached result.
+
+    Once a result expires it is returned with "recomputing" set while a Celery
+    task refreshes it, if CELERY_BROKER_URL is configured. Otherwise, and without
+    Redis or when nothing is cached, the analysis is computed synchronously.
+    """
+    if not redis_client:
+        return analyze_portfolio(user_id)
+
+    try:
+        cached, fresh = redis_client.mget([_result_key(user_id), _fresh_key(user_id)])
+    except Exception as e:
+        logger.warning("Error reading cached portfolio analysis: %s", e)
+        return analyze_portfolio(user_id)
+    if cached is None:
+        return store_portfolio_analysis(user_id)
+
+    if fresh is None and not CELERY_BROKER_URL:
+        return store_portfolio_analysis(user_id)
+
+    result = pickle.loads(cached)
+    if fresh is None:
+        # Mark as pending first so concurrent requests don't queue duplicate tasks
+        try:
+            if redis_client.set(_fresh_key(user_id), _PENDING, ex=ANALYSIS_TTL, nx=True):
+                analyze_portfolio_task.delay(user_id)
+        except Exception as e:
+            logger.warning("Error queueing portfolio analysis: %s", e)
+            _clear_pending(user_id)
+        result["recomputing"] = True
+    elif fresh == _PENDING:
+        result["recomputing"] = True
+    return result